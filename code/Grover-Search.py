@@ -11,15 +11,25 @@ of lookups to only 1000, in the worst case.
 This program simulates the above scenario on a smaller scale.
 '''
 
+import io
+import sys
 import json
 import random
-from os import getenv
+import argparse
+import pickle
+import hashlib
+import tempfile
+from os import getenv, makedirs, path, replace
+import numpy as np
 from dotenv import load_dotenv
 import matplotlib.pyplot as plt
-from qiskit import transpile, assemble, IBMQ
+import qiskit
+from qiskit import transpile, IBMQ
+from qiskit.providers.ibmq.exceptions import IBMQAccountCredentialsNotFound
 from qiskit.quantum_info import Statevector
 from qiskit.algorithms import AmplificationProblem, Grover
-from qiskit_ibm_runtime import QiskitRuntimeService, Sampler, Session
+from qiskit_ibm_runtime import QiskitRuntimeService, Sampler, Session, Options
+from qiskit_aer.primitives import Sampler as AerSampler
 from qiskit.tools.visualization import plot_histogram
 from qiskit.tools.monitor import job_monitor
 
@@ -30,20 +40,25 @@ load_dotenv()
 TOKEN = getenv('IBM_QUANTUM_TOKEN')
 USED_BACKEND = 'ibm_oslo'
 FILE_TO_WRITE_NAME ='History.txt'
+TRANSPILE_CACHE_DIRECTORY = 'transpile-cache'
+TRANSPILER_SEED = 1234
+TRANSPILER_OPTIMIZATION_LEVEL = 3
 
 # Function used for printing quantum circuits as matplotlib images
+# The figures are only created here and shown with the next plt.show(), so drawing does not block the program.
 def print_quantum_circuits(circuits):
-
-    #Matplotlib output, freezes the program execution until windows are closed
     for circuit in circuits:
         circuit.draw(output = 'mpl')
-    plt.show()
 
 # Function used for connecting to the IBM quantum computer
+# The account is saved to disk only on the first run, after that the saved account is loaded.
 # TODO: Remove deprecated components
 def connect_to_cloud(token, backend):
-    IBMQ.save_account(token, overwrite=True)
-    provider = IBMQ.load_account()
+    try:
+        provider = IBMQ.load_account()
+    except IBMQAccountCredentialsNotFound:
+        IBMQ.save_account(token)
+        provider = IBMQ.load_account()
     provider = IBMQ.get_provider(hub='ibm-q', group='open', project='main')
     used_backend = provider.get_backend(backend) # for lower latency choosing the geographically closest one
     print(f"The used backend is: {used_backend}")
@@ -57,49 +72,133 @@ def write_to_history(randomized_entry, job_id):
     results_history.write("\n" + str(randomized_entry) + " " + str(job_id) + "\n")
     results_history.close()
 
-# Run the Grover search on a simulator backend.
+# Run the Grover search on a local Aer simulator backend.
+# All circuits are submitted in a single run so that their shots are simulated as one batch instead of one job per circuit.
+# The circuits are so small that spawning parallel threads costs more than the simulation itself, so it is kept single-threaded.
+# A simulator can run any gate, so the circuits are only translated to its basis gates without any optimization.
+# TODO: Refactor logging/printing to separate component.
+def run_grover_in_simulator(grover_circuits, shots, draw_circuits):
+    sampler = AerSampler(backend_options={
+        "method": "statevector",
+        "batched_shots_gpu": True, # only has an effect when a GPU device is available
+        "batched_shots_gpu_max_qubits": 16,
+        "max_parallel_threads": 1,
+        "max_parallel_shots": 1
+        }, transpile_options={"optimization_level": 0})
+    job = sampler.run(circuits=grover_circuits, shots=shots)
+    if draw_circuits:
+        print_quantum_circuits(grover_circuits)
+    result = job.result()
+    print('===================================== RESULTS =====================================')
+    print(f"{result.quasi_dists}")
+    print(f"{result.metadata}")
+    return result, job
+
+# Run the Grover search on the IBM cloud simulator backend.
+# NOTE: Every run is a round trip to the cloud, so the local simulator is usually significantly faster.
+# Like with the local simulator, the circuits are not optimized by the transpiler.
+# All circuits are sampled in a single job inside one session.
 # TODO: Refactor logging/printing to separate component.
-def run_grover_in_simulator(grover_circuits):
+def run_grover_in_cloud_simulator(grover_circuits, shots, draw_circuits):
     service = QiskitRuntimeService()
     backend_simulator = "ibmq_qasm_simulator"
     with Session(service=service, backend=backend_simulator):
-        sampler = Sampler()
-        job = sampler.run(circuits=grover_circuits, shots=1000)
+        sampler = Sampler(options=Options(optimization_level=0))
+        job = sampler.run(circuits=grover_circuits, shots=shots)
+        if draw_circuits:
+            print_quantum_circuits(grover_circuits)
         job_monitor(job)
         result = job.result() 
         print('===================================== RESULTS =====================================')
         print(f"{result.quasi_dists}")
         print(f"{result.metadata}")
-        qubits = 3
-        optimal_amount = Grover.optimal_num_iterations(1, qubits)
-        print(f"The optimal amount of Grover iterations is: {optimal_amount} with {qubits}  qubits")
         return result, job
 
+# Transpile the circuits for the given backend with the heaviest optimization level.
+# The transpiler is seeded, so the mapped circuits are stored on disk and reused on the next run with the same circuits, backend calibration,
+# transpiler settings and Qiskit version. An unreadable cache file is ignored and the circuits are transpiled again.
+def transpile_for_backend(grover_circuits, backend):
+    cache_key = hashlib.sha256()
+    cache_key.update(backend.name().encode())
+    cache_key.update(str(backend.configuration().coupling_map).encode())
+    properties = backend.properties() # the calibration data used by the transpiler to choose the layout
+    cache_key.update(str(properties.last_update_date if properties is not None else None).encode())
+    cache_key.update(f"{TRANSPILER_OPTIMIZATION_LEVEL} {TRANSPILER_SEED} {qiskit.__version__}".encode())
+    for circuit in grover_circuits:
+        cache_key.update(circuit.qasm().encode())
+    cache_file = path.join(TRANSPILE_CACHE_DIRECTORY, f"{cache_key.hexdigest()}.pickle")
+    if path.exists(cache_file):
+        try:
+            with open(cache_file, 'rb') as f:
+                return pickle.load(f)
+        except (EOFError, pickle.UnpicklingError, AttributeError):
+            print(f"Could not read the cached circuits from {cache_file}, transpiling again")
+    mapped_circuit = transpile(grover_circuits, backend=backend, optimization_level=TRANSPILER_OPTIMIZATION_LEVEL, seed_transpiler=TRANSPILER_SEED)
+    makedirs(TRANSPILE_CACHE_DIRECTORY, exist_ok=True)
+    # The circuits are written to a temporary file first, so a half-written cache file is never left in place
+    with tempfile.NamedTemporaryFile('wb', dir=TRANSPILE_CACHE_DIRECTORY, suffix='.tmp', delete=False) as f:
+        pickle.dump(mapped_circuit, f)
+    replace(f.name, cache_file)
+    return mapped_circuit
+
 # Run the Grover search on a real quantum computer backend.
-def run_grover_in_quantum_computer(random_name_formatted, backend, grover_circuits):
+def run_grover_in_quantum_computer(random_name_formatted, backend, grover_circuits, shots, draw_circuits):
     print(f"The value, which we are looking for is: {random_name_formatted}")
-    mapped_circuit = transpile(grover_circuits, backend=backend)
-    quantum_object = assemble(mapped_circuit, backend=backend, shots=1000)
-    job = backend.run(quantum_object)
+    mapped_circuit = transpile_for_backend(grover_circuits, backend)
+    job = backend.run(mapped_circuit, shots=shots)
+    if draw_circuits:
+        print_quantum_circuits(grover_circuits)
     job_monitor(job)
     job_id = job.job_id()
     result = job.result()
     print(result)
+    if draw_circuits:
+        plt.show()
     return result, job
 
+# Build one measured Grover search circuit for each amount of iterations in values (in ascending order).
+# The Grover operator (oracle + diffusion) is synthesized and decomposed only once, and then appended as a single gate to the circuit one iteration at a time.
+# This way every circuit shares the same definition and the multi-controlled gates are not decomposed again for each iteration.
+def build_grover_circuits(marked_state, values):
+    oracle = Statevector.from_label(marked_state) # Oracle, which is a black-box quantum circuit telling if your guess is right or wrong. We will let the oracle know the owner.
+    unstructured_search = AmplificationProblem(oracle, is_good_state=marked_state) # Grover's algorithm uses a technique for modifying quantum states to raise the probability amplitude of the wanted value
+    grover_operator = unstructured_search.grover_operator
+    grover_iteration = transpile(grover_operator, basis_gates=['cx', 'u3'], optimization_level=3, seed_transpiler=TRANSPILER_SEED).to_gate(label='Grover')
+    quantum_circuit = unstructured_search.state_preparation.copy()
+    grover_circuits = []
+    applied_iterations = 0
+    for value in values:
+        for _ in range(value - applied_iterations):
+            quantum_circuit.append(grover_iteration, range(grover_operator.num_qubits))
+        applied_iterations = value
+        grover_circuits.append(quantum_circuit.measure_all(inplace=False))
+    return grover_circuits
+
+# Write the report of the simulator run: the most probable value for every amount of iterations and if it was correct.
+# The report is collected into a buffer and written out at once instead of printing line by line
+def write_simulator_report(binary_probabilities, answers, correct_answers, random_name, qubits, values):
+    report = io.StringIO()
+    for distribution in range(0, len(binary_probabilities)):
+        report.write(f"With {values[distribution]} iterations the following probabilities were returned: \n {binary_probabilities[distribution]}\n")
+        report.write(f"Maximum probability was for the value {answers[distribution]:0{qubits}b}\n")
+        report.write(f"Correct answer: {random_name:0{qubits}b}\n")
+        report.write('Correct!\n' if correct_answers[distribution] else 'Failure!\n')
+        report.write('\n\n')
+    sys.stdout.write(report.getvalue())
+
 # Visualize the results gotten from the simulator run.
 # TODO: Refactor logging/printing to separate component.
-def visualize_simulator_results(result, random_name_formatted):
-    for distribution in range(0, len(result.quasi_dists)):
-        results_dictionary = result.quasi_dists[distribution].binary_probabilities()
-        answer = max(results_dictionary, key=results_dictionary.get)
-        print(f"With {distribution + 1} iterations the following probabilities were returned: \n {result.quasi_dists[distribution]}")
-        print(f"Maximum probability was for the value {answer}")
-        print(f"Correct answer: {random_name_formatted}")
-        print('Correct!' if answer == random_name_formatted else 'Failure!')
-        print('\n')
-    histogram = plot_histogram(result.quasi_dists, legend=['1 iteration', '2 iterations', '3 iterations', '4 iterations', '5 iterations', '6 iterations', '7 iterations', '8 iterations'])
-    plt.xlabel("Which entry in the data [0,..,7]")
+def visualize_simulator_results(result, random_name, qubits, values):
+    # The quasi-distributions only contain the measured values, so the most probable value is searched from them directly
+    # instead of expanding every distribution to all the 2^n possible values.
+    answers = np.asarray([max(quasi_distribution, key=quasi_distribution.get) for quasi_distribution in result.quasi_dists])
+    # The answers are kept as integers, so all of them are checked against the correct value at once
+    correct_answers = answers == random_name
+    # The bit string keyed probabilities are created once and used both for printing and for the histogram
+    binary_probabilities = [quasi_distribution.binary_probabilities() for quasi_distribution in result.quasi_dists]
+    write_simulator_report(binary_probabilities, answers, correct_answers, random_name, qubits, values)
+    histogram = plot_histogram(binary_probabilities, legend=[f"{value} iterations" for value in values])
+    plt.xlabel(f"Which entry in the data [0,..,{2 ** qubits - 1}]")
     plt.show()
 
 def visualize_existing_simulator_results():
@@ -119,7 +218,7 @@ def visualize_existing_qc_results():
         plt.show()
 
 # The real program execution starts here.
-def run_grover():
+def run_grover(arguments):
     
     # Commented out, used during the writing of the seminar report to visualize results to use in the report
     # TODO: Refactor to get results straight from the cloud with job id, or give path as parameter
@@ -127,83 +226,89 @@ def run_grover():
     # visualize_existing_qc_results()
 
     # STEP 1: Construct and define the unstructured search problem.
-    random_name = random.randint(0,7) # This simulates a random person from a phone book containing 8 entries [0,..,7]. As 8 = 2³, we need 3 qubits.
-    random_name_formatted = format(random_name, '03b') # This formats the random person's name to a 3-bit string
-    oracle = Statevector.from_label(random_name_formatted) # Oracle, which is a black-box quantum circuit telling if your guess is right or wrong. We will let the oracle know the owner.
-    unstructured_search = AmplificationProblem(oracle, is_good_state=random_name_formatted) # Grover's algorithm uses a technique for modifying quantum states to raise the probability amplitude of the wanted value
+    random_name = random.randint(0, 2 ** arguments.n_qubits - 1) # This simulates a random person from a phone book containing 2^n entries [0,..,2^n - 1]. With the default 3 qubits there are 8 entries.
+    random_name_formatted = format(random_name, f'0{arguments.n_qubits}b') # This formats the random person's name to a n-bit string, used as the oracle label and in the history. The results are compared to the integer.
 
     # STEP 2: Constructing the adequate quantum circuit for the problem
-    grover_circuits = []
-
     # Grover's algorithm's accuracy to find the right solution increases with the amount of iterations ip to a certain point (in theory).
-    values = [0, 1, 2, 3, 4, 5, 6, 7]
-    for value in range(0, len(values)):
-        grover = Grover(iterations=values[value]) # using Grover's algorithm straight from the Qiskit library
-        quantum_circuit = grover.construct_circuit(unstructured_search)
-        quantum_circuit.measure_all()
-        grover_circuits.append(quantum_circuit)
-
-    # Commented for now so the program does not freeze
-    # Used for printing the quantum circuits if interested to see them
-    # print_quantum_circuits(grover_circuits)
+    # Zero iterations only gives the uniform distribution and iterations past the optimal amount amplify the wrong answers, so by default only the ones around the optimum are run.
+    optimal_amount = Grover.optimal_num_iterations(1, arguments.n_qubits)
+    print(f"The optimal amount of Grover iterations is: {optimal_amount} with {arguments.n_qubits}  qubits")
+    if arguments.full_sweep:
+        values = list(range(2 ** arguments.n_qubits))
+    else:
+        values = sorted({max(1, optimal_amount - 1), max(1, optimal_amount), optimal_amount + 1})
+    grover_circuits = build_grover_circuits(random_name_formatted, values)
 
     # STEP 3: Submit the circuits to IBM Quantum Computer or run with a simulator
     # NOTE: Occasionally the simulator is significantly faster than the real computer due to queue
-    try:
-        user_option = int(input(
-            "Press \n 1 for simulator \n 2 for real hardware \n 3 for retrieving an existing job by job_id \n 4 for both simulator and real hardware \n"
-            ))
-    except ValueError:
-        raise ValueError('Please give an integer')    
-
 
-    # Simulator
-    if user_option == 1:
+    # Local simulator
+    if arguments.backend == 'sim':
         
         # Result from Grover's algorithm
-        result, job = run_grover_in_simulator(grover_circuits)    
+        result, job = run_grover_in_simulator(grover_circuits, arguments.shots, arguments.draw_circuits)    
         
         # Write the randomized entry and job id of the run to a file
-        write_to_history(random_name_formatted, job)
+        write_to_history(random_name_formatted, job.job_id())
     
         # Counting probabilities and doing plotting & visualization with matplotlib
-        visualize_simulator_results(result, random_name_formatted)
+        visualize_simulator_results(result, random_name, arguments.n_qubits, values)
 
     # Real quantum computer
-    elif user_option == 2:
+    elif arguments.backend == 'hw':
         # Connect to IBM cloud and get the backend provider.
         backend = connect_to_cloud(TOKEN, USED_BACKEND)
-        result = run_grover_in_quantum_computer(random_name_formatted, backend, grover_circuits)
+        result, job = run_grover_in_quantum_computer(random_name_formatted, backend, grover_circuits, arguments.shots, arguments.draw_circuits)
 
         # Write the randomized entry and job id of the run to a file
-        write_to_history(random_name_formatted, result.job_id())
+        write_to_history(random_name_formatted, job.job_id())
     
     # Due to occasional queues (45 minutes to 4 hours) in the free-tier quantum computer, it is easier to investigate and experiment by using previous runs, which can be obtained with the job id.
-    elif user_option == 3:
-        job_id = input("Give job id: ")
+    elif arguments.backend == 'retrieve':
         backend = connect_to_cloud(TOKEN, USED_BACKEND)
-        result = backend.retrieve_job(job_id)
+        result = backend.retrieve_job(arguments.job_id)
         print(f"as a dict: {result.result().to_dict()}")
         all_results_as_dict = result.result().to_dict()
         print(all_results_as_dict)
 
     # This runs the job on a simulator and on the real hardware for the same randomized value.
     # Decided to create this due to better and transparent comparison for the different systems.
-    elif user_option == 4:
-        result = run_grover_in_simulator(grover_circuits)
+    elif arguments.backend == 'both':
+        result = run_grover_in_simulator(grover_circuits, arguments.shots, arguments.draw_circuits)
         write_to_history(random_name_formatted, result[1].job_id())
-        visualize_simulator_results(result[0], random_name_formatted)
+        visualize_simulator_results(result[0], random_name, arguments.n_qubits, values)
         backend = connect_to_cloud(TOKEN, USED_BACKEND)
-        quantum_job_result_and_id = run_grover_in_quantum_computer(random_name_formatted, backend, grover_circuits)
+        quantum_job_result_and_id = run_grover_in_quantum_computer(random_name_formatted, backend, grover_circuits, arguments.shots, arguments.draw_circuits)
         write_to_history(random_name_formatted, quantum_job_result_and_id[1].job_id())
 
-    # Undefined input closes the program.
-    else:
-        print("Closing program!")
-        exit()
+    # The same as the local simulator, but the circuits are run in the IBM cloud simulator instead.
+    elif arguments.backend == 'cloud-sim':
+        result, job = run_grover_in_cloud_simulator(grover_circuits, arguments.shots, arguments.draw_circuits)
+        write_to_history(random_name_formatted, job.job_id())
+        visualize_simulator_results(result, random_name, arguments.n_qubits, values)
+
+# The options are given as command line arguments, so the program can be run without user interaction (e.g. several runs in parallel).
+def parse_arguments():
+    parser = argparse.ArgumentParser(description="Grover's search algorithm on a simulator or on real IBM quantum hardware.")
+    parser.add_argument('--backend', choices=['sim', 'hw', 'retrieve', 'both', 'cloud-sim'], default='sim',
+        help="sim: local simulator, hw: real hardware, retrieve: existing job by --job-id, both: simulator and real hardware, cloud-sim: IBM cloud simulator")
+    parser.add_argument('--shots', type=int, default=1000)
+    parser.add_argument('--n-qubits', type=int, default=3)
+    parser.add_argument('--job-id', help="Job id of an existing job, used with --backend retrieve")
+    parser.add_argument('--full-sweep', action='store_true', help="Run every amount of iterations from 0 to 2^n - 1 instead of only the ones around the optimal amount")
+    parser.add_argument('--draw-circuits', action='store_true', help="Draw the quantum circuits while the job is running")
+    arguments = parser.parse_args()
+    if arguments.backend == 'retrieve' and arguments.job_id is None:
+        parser.error("--job-id is required with --backend retrieve")
+    if arguments.shots < 1:
+        parser.error("--shots must be at least 1")
+    if arguments.n_qubits < 1:
+        parser.error("--n-qubits must be at least 1")
+    return arguments
 
 def main():
-    run_grover()
+    run_grover(parse_arguments())
 
 if __name__ == "__main__":
     main()